@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+# Time matching artists in a library of 50k artists, each with one
+# album of one song. Run from the repository root:
+#
+#     $ python benchmarks/matchers.py [NUM_ARTISTS]
+#
+# For each matcher this reports the time taken by collect_matched_songs
+# and, for the artist directory names alone, by apply_escaped_matchers
+# compared to unescaping every name and calling apply_matchers.
+
+import collections
+import os
+import pathlib
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+import fstunes  # noqa: E402
+
+NUM_ARTISTS = 50000
+
+MATCHES = (
+    ["-m", "artist=Artist 12345"],
+    ["--match-set", "artist=Artist 1,Artist 2,Artist 3"],
+    ["--match-prefix", "artist=The "],
+    ["-m", "artist~^The "],
+    ["--match-icase", "artist=the artist 4242"],
+    ["-m", "artist~[0-9]7$"],
+)
+
+def artist_name(i):
+    # Every other artist has a name that needs escaping.
+    if i % 4 == 0:
+        return "The Artist {}".format(i)
+    elif i % 4 == 1:
+        return "Artist {}".format(i)
+    elif i % 4 == 2:
+        return "Art/ist {}".format(i)
+    else:
+        return "Artiste Émigré {}".format(i)
+
+def make_library(home, num_artists):
+    media = home / fstunes.MEDIA_PLAYLIST
+    for i in range(num_artists):
+        relpath = fstunes.create_relpath({
+            "artist": artist_name(i),
+            "album": "Album",
+            "track": 1,
+            "song": "Song",
+            "extension": ".mp3",
+        })
+        (media / relpath).parent.mkdir(parents=True)
+        (media / relpath).touch()
+    (home / "playlists").mkdir()
+
+def parse(match):
+    args = fstunes.get_parser().parse_args(["insert", *match, "x", "0"])
+    return fstunes.parse_matchers(args, default_to_media=True)
+
+def main():
+    num_artists = int(sys.argv[1]) if len(sys.argv) > 1 else NUM_ARTISTS
+    with tempfile.TemporaryDirectory() as tmp:
+        home = pathlib.Path(tmp)
+        make_library(home, num_artists)
+        env = {
+            "home": home,
+            "media": home / fstunes.MEDIA_PLAYLIST,
+            "playlists": home / "playlists",
+            "queue": home / "playlists" / fstunes.QUEUE_PLAYLIST,
+            "queue_current": (
+                home / "playlists" / fstunes.QUEUE_PLAYLIST / "_current"),
+            "playlist_format": "symlink",
+        }
+        names = os.listdir(env["media"])
+        print("{} artists".format(len(names)))
+        for match in MATCHES:
+            matchers = parse(match)
+            artist_matchers = matchers["artist"]
+            collect = timeit.timeit(
+                lambda: fstunes.collect_matched_songs(env, matchers),
+                number=3) / 3
+            songs = fstunes.collect_matched_songs(env, matchers)
+            escaped = timeit.timeit(
+                lambda: collections.deque(
+                    (fstunes.apply_escaped_matchers(artist_matchers, name)
+                     for name in names), maxlen=0),
+                number=3) / 3
+            unescaped = timeit.timeit(
+                lambda: collections.deque(
+                    (fstunes.apply_matchers(
+                        artist_matchers, fstunes.unescape_string(name))
+                     for name in names), maxlen=0),
+                number=3) / 3
+            print("{:45} {:6} songs  collect {:7.1f} ms  "
+                  "names {:6.1f} ms (unescaping all: {:6.1f} ms)"
+                  .format(" ".join(match), len(songs), collect * 1000,
+                          escaped * 1000, unescaped * 1000))
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,23 @@
 import argparse
 import bisect
 import collections
+import concurrent.futures
+import contextlib
+import fcntl
+import functools
+import hashlib
+import json
 import math
 import mutagen
 import os
 import pathlib
+import queue
 import random
 import re
 import shutil
 import string
 import sys
+import threading
 
 def has_duplicates(l):
     return len(l) != len(set(l))
@@ -57,13 +65,20 @@ def add_yes_option(parser):
     parser.add_argument("-y", "--yes", action="store_true",
                         help="Don't ask for confirmation")
 
+DEFAULT_JOBS = 16
+
+def add_jobs_option(parser):
+    parser.add_argument("-j", "--jobs", type=int, default=DEFAULT_JOBS,
+                        metavar="N",
+                        help="Number of directories to read in parallel")
+
 def add_fields_option(parser):
     parser.add_argument("-f", "--fields", metavar="FIELD1,FIELD2,...",
                         help="Which metadata fields to include")
 
 def add_match_options(parser):
     parser.add_argument("-m", "--match", metavar="FIELD=EXPR", action="append",
-                        help="Filter songs")
+                        help="Filter songs (FIELD~REGEX for a regex)")
     parser.add_argument("--match-literal", metavar="FIELD=VALUE",
                         action="append", help="Filter songs by literal match")
     parser.add_argument("--match-set", metavar="FIELD=VALUE1,VALUE2,...",
@@ -71,6 +86,14 @@ def add_match_options(parser):
     parser.add_argument("--match-range", metavar="FIELD=LOW-HIGH",
                         action="append",
                         help="Filter songs by range inclusion")
+    parser.add_argument("--match-regex", metavar="FIELD=REGEX",
+                        action="append",
+                        help="Filter songs by regular expression search")
+    parser.add_argument("--match-prefix", metavar="FIELD=PREFIX",
+                        action="append", help="Filter songs by prefix")
+    parser.add_argument("--match-icase", metavar="FIELD=VALUE",
+                        action="append",
+                        help="Filter songs by case-insensitive match")
     parser.add_argument("-M", "--match-all", metavar="FIELD", action="append",
                         help="Do not filter songs")
 
@@ -78,6 +101,8 @@ def add_match_options(parser):
                         help="Delimiter to use for set filtering")
     parser.add_argument("--range-delimiter", default="-", metavar="DELIM",
                         help="Delimiter to use for range filtering")
+    parser.add_argument("--explain", action="store_true",
+                        help="Show how matching songs were looked up")
 
 SORT_OPTION_STRINGS = ("-s", "--sort")
 REVERSE_OPTION_STRINGS = ("-r", "--reverse")
@@ -118,7 +143,13 @@ def get_parser():
     parser_import = subparsers.add_parser(
         "import", help="Add media files to library")
     parser_import.add_argument(
-        "paths", nargs="+", metavar="path", help="Media file or directory")
+        "paths", nargs="*", metavar="path", help="Media file or directory")
+    parser_import.add_argument(
+        "--from-stdin", action="store_true",
+        help="Read paths of media files from stdin, one per line")
+    parser_import.add_argument(
+        "-0", "--null", action="store_true",
+        help="Paths on stdin are separated by NUL instead of newline")
 
     parser_playlist = subparsers.add_parser(
         "playlist", help="Create or delete playlists")
@@ -138,10 +169,18 @@ def get_parser():
         help="Name of playlist to delete")
     add_yes_option(parser_playlist_delete)
 
+    parser_playlist_migrate = subparsers_playlist.add_parser(
+        "migrate", help="Convert all playlists to another storage format")
+    parser_playlist_migrate.add_argument(
+        "format", choices=PLAYLIST_FORMATS,
+        help="Storage format to convert to")
+    add_yes_option(parser_playlist_migrate)
+
     parser_insert = subparsers.add_parser(
         "insert", help="Add songs to a playlist or the queue")
     add_match_options(parser_insert)
     add_sort_options(parser_insert)
+    add_jobs_option(parser_insert)
     parser_insert.add_argument(
         "-t", "--transfer", action="store_true",
         help="Also remove songs from original playlists")
@@ -178,6 +217,10 @@ def get_parser():
     add_match_options(parser_list)
     add_sort_options(parser_list)
     add_fields_option(parser_list)
+    add_jobs_option(parser_list)
+    parser_list.add_argument(
+        "--summary", choices=SUMMARY_FIELDS,
+        help="Only count songs for each value of a field")
 
     parser_delete = subparsers.add_parser(
         "delete", help="Delete media files from library")
@@ -196,6 +239,13 @@ def get_parser():
     parser_seek.add_argument(
         "index", type=int, nargs="?", help="Relative index to which to seek")
 
+    parser_fsck = subparsers.add_parser(
+        "fsck", help="Check library for inconsistencies")
+    add_jobs_option(parser_fsck)
+    parser_fsck.add_argument(
+        "--repair", action="store_true", help="Fix problems where possible")
+    add_yes_option(parser_fsck)
+
     return parser
 
 def read_mutagen_key(m, key):
@@ -206,6 +256,8 @@ def read_mutagen_key(m, key):
 
 def read_metadata(filepath):
     m = mutagen.File(filepath)
+    if m is None:
+        raise mutagen.MutagenError("unknown file type: {}".format(filepath))
     metadata = {}
     metadata["artist"] = (read_mutagen_key(m, "TPE2") or
                           read_mutagen_key(m, "TPE1"))
@@ -246,18 +298,23 @@ MISSING_FIELD = "---"
 
 def create_relpath(metadata):
     disk_str = (
-        "{}-".format(metadata["disk"]) if "disk" in metadata else "")
+        "{}-".format(metadata["disk"])
+        if metadata.get("disk") is not None else "")
+    track_str = (
+        str(metadata["track"]) if metadata.get("track") is not None else "")
     return pathlib.Path("{}/{}/{}{} {}{}".format(
         escape_string(metadata["artist"] or MISSING_FIELD),
         escape_string(metadata["album"] or MISSING_FIELD),
         disk_str,
-        metadata.get("track", ""),
+        track_str,
         escape_string(metadata.get("song") or MISSING_FIELD),
         metadata["extension"]))
 
 def parse_relpath(relpath):
     match = re.fullmatch(
         r"([^/]+)/([^/]+)/(?:([0-9]+)-)?([0-9]+)? (.+)", str(relpath))
+    if not match:
+        raise ValueError("malformed media path: {}".format(relpath))
     artist = unescape_string(match.group(1))
     if artist == MISSING_FIELD:
         artist = None
@@ -289,13 +346,34 @@ def parse_relpath(relpath):
         "extension": extension,
     }
 
-def import_song(env, filepath):
-    metadata = read_metadata(filepath)
+def parse_library_relpath(relpath):
+    try:
+        return parse_relpath(relpath)
+    except ValueError as e:
+        die("{} (run 'fstunes fsck' for details)".format(e))
+
+def parse_legacy_relpath(relpath):
+    # Older versions of fstunes wrote a missing disk or track number
+    # as "None". Return the metadata such a path stands for, or None if
+    # it is not of that form.
+    relpath = pathlib.Path(relpath)
+    match = re.fullmatch(r"(None|[0-9]+)-(None|[0-9]+) (.+)", relpath.name)
+    if not match or "None" not in match.group(1, 2):
+        return None
+    disk, track, rest = match.groups()
+    name = "{}{} {}".format(
+        "" if disk == "None" else disk + "-",
+        "" if track == "None" else track,
+        rest)
+    try:
+        return parse_relpath(relpath.parent / name)
+    except ValueError:
+        return None
+
+def import_song(env, filepath, metadata):
     relpath = create_relpath(metadata)
     target = env["media"] / relpath
     if target.exists() or target.is_symlink():
-        log("skipping, already exists: {} => {}"
-            .format(filepath, target))
         return False
     target.parent.mkdir(parents=True, exist_ok=True)
     shutil.copyfile(filepath, target)
@@ -303,40 +381,413 @@ def import_song(env, filepath):
 
 MEDIA_EXTENSIONS = [".mp3"]
 
-def import_music(env, paths):
-    copied = 0
-    already_present = 0
-    skipped = 0
+IMPORT_QUEUE_SIZE = 256
+IMPORT_PROGRESS_INTERVAL = 2
+IMPORT_READ_SIZE = 1 << 16
+
+def walk_paths(paths):
     for path in paths:
         path = pathlib.Path(path).resolve()
         for dirpath, dirnames, filenames in os.walk(path):
             dirnames.sort()
             filenames.sort()
-            already_reported_dir = False
             for filename in filenames:
-                filepath = pathlib.Path(dirpath) / filename
-                suffix = filepath.suffix
-                if suffix not in MEDIA_EXTENSIONS:
-                    log("skipping, extension {} not recognized: {}"
-                        .format(repr(suffix), filepath))
-                    skipped += 1
-                    continue
-                if not already_reported_dir:
-                    log("importing media from directory: {}"
-                        .format(filepath.parent))
-                    already_reported_dir = True
-                if import_song(env, filepath):
-                    copied += 1
-                else:
-                    already_present += 1
+                yield pathlib.Path(dirpath) / filename
+
+def read_stdin_paths(delimiter):
+    remainder = b""
+    while True:
+        chunk = sys.stdin.buffer.read1(IMPORT_READ_SIZE)
+        if not chunk:
+            break
+        parts = (remainder + chunk).split(delimiter)
+        remainder = parts.pop()
+        for part in parts:
+            if part:
+                yield pathlib.Path(os.fsdecode(part))
+    if remainder:
+        yield pathlib.Path(os.fsdecode(remainder))
+
+# Sentinel passed down the import pipeline once a stage has finished.
+IMPORT_DONE = object()
+
+def run_import_stage(function, outbox, errors):
+    def run():
+        try:
+            function()
+        except BaseException as e:
+            errors.append(e)
+        finally:
+            outbox.put(IMPORT_DONE)
+    threading.Thread(target=run, daemon=True).start()
+
+def iter_import_queue(inbox):
+    while True:
+        item = inbox.get()
+        if item is IMPORT_DONE:
+            return
+        yield item
+
+def import_music(env, filepaths):
+    stats = collections.Counter()
+    errors = []
+    parse_queue = queue.Queue(IMPORT_QUEUE_SIZE)
+    copy_queue = queue.Queue(IMPORT_QUEUE_SIZE)
+
+    def read_paths():
+        for filepath in filepaths:
+            stats["read"] += 1
+            if filepath.suffix not in MEDIA_EXTENSIONS:
+                stats["unrecognized"] += 1
+                continue
+            parse_queue.put(filepath)
+
+    # A path that cannot be read is counted and skipped, since a long
+    # list of paths is likely to have some that are stale or damaged.
+    def parse_tags():
+        for filepath in iter_import_queue(parse_queue):
+            try:
+                metadata = read_metadata(filepath)
+            except (mutagen.MutagenError, OSError):
+                stats["unreadable"] += 1
+                continue
+            copy_queue.put((filepath, metadata))
+
+    # Progress is reported from its own thread so that it keeps coming
+    # at a steady rate while paths are skipped before they are parsed.
+    def report_progress():
+        while not finished.wait(IMPORT_PROGRESS_INTERVAL):
+            log(("read {} path{}, imported {}, skipped {} unrecognized "
+                 "and {} unreadable so far")
+                .format(*plurals(stats["read"]), stats["copied"],
+                        stats["unrecognized"], stats["unreadable"]))
+
+    finished = threading.Event()
+    run_import_stage(read_paths, parse_queue, errors)
+    run_import_stage(parse_tags, copy_queue, errors)
+    threading.Thread(target=report_progress, daemon=True).start()
+    try:
+        for filepath, metadata in iter_import_queue(copy_queue):
+            if import_song(env, filepath, metadata):
+                stats["copied"] += 1
+            else:
+                stats["already_present"] += 1
+    finally:
+        finished.set()
+    if errors:
+        raise errors[0]
     log(("imported {} media file{}, skipped {} "
-         "already present and {} unrecognized")
-        .format(*plurals(copied), already_present, skipped))
+         "already present, {} unrecognized and {} unreadable")
+        .format(*plurals(stats["copied"]), stats["already_present"],
+                stats["unrecognized"], stats["unreadable"]))
 
 MEDIA_PLAYLIST = "media"
 QUEUE_PLAYLIST = "queue"
 RESERVED_PLAYLISTS = (MEDIA_PLAYLIST, QUEUE_PLAYLIST)
 
+PLAYLIST_FORMAT_FILE = "playlist-format"
+PLAYLIST_FORMATS = ("symlink", "file")
+DEFAULT_PLAYLIST_FORMAT = "symlink"
+PLAYLIST_ENTRIES_FILE = "_entries"
+PLAYLIST_FILE_HEADER = "fstunes-playlist"
+
+def get_playlist_format(home):
+    try:
+        playlist_format = (home / PLAYLIST_FORMAT_FILE).read_text().strip()
+    except FileNotFoundError:
+        return DEFAULT_PLAYLIST_FORMAT
+    if playlist_format not in PLAYLIST_FORMATS:
+        die("unsupported playlist format in {}: {}"
+            .format(home / PLAYLIST_FORMAT_FILE, playlist_format))
+    return playlist_format
+
+def set_playlist_format(env, playlist_format):
+    format_path_new = env["temp"] / PLAYLIST_FORMAT_FILE
+    format_path_new.parent.mkdir(parents=True, exist_ok=True)
+    format_path_new.write_text(playlist_format + "\n")
+    format_path_new.rename(env["home"] / PLAYLIST_FORMAT_FILE)
+
+def symlink_target(relpath):
+    return pathlib.Path("..") / ".." / MEDIA_PLAYLIST / relpath
+
+def iter_symlink_playlist(playlist_path):
+    for entry_path in playlist_path.iterdir():
+        try:
+            index = int(entry_path.name)
+        except ValueError:
+            continue
+        yield index, entry_path
+
+def read_symlink_indices(playlist_path):
+    # Return the indices of the entries that read_symlink_playlist
+    # reads, skipping entries that are not symlinks without a stat.
+    indices = []
+    with os.scandir(playlist_path) as it:
+        for entry in it:
+            try:
+                index = int(entry.name)
+            except ValueError:
+                continue
+            if entry.is_symlink():
+                indices.append(index)
+    return indices
+
+def read_symlink_playlist(env, playlist_path, predicate, indices, plan_level):
+    if indices is not None:
+        entry_paths = [(index, playlist_path / str(index))
+                       for index in indices]
+        plan_level["lookup"] += 1
+        plan_level["estimated"] += len(indices)
+    else:
+        entry_paths = list(iter_symlink_playlist(playlist_path))
+        plan_level["listing"] += 1
+        plan_level["estimated"] += DEFAULT_DIR_ESTIMATE
+    plan_level["touched"] += len(entry_paths)
+    entries = {}
+    for index, entry_path in entry_paths:
+        if not predicate(index):
+            continue
+        if not entry_path.is_symlink():
+            continue
+        try:
+            entries[index] = entry_path.resolve().relative_to(env["media"])
+        except ValueError:
+            die("playlist entry points outside of media: {} "
+                "(run 'fstunes fsck' for details)".format(entry_path))
+    return entries
+
+def write_symlink_playlist(env, playlist_path, entries):
+    for _, entry_path in iter_symlink_playlist(playlist_path):
+        entry_path.unlink()
+    for index, relpath in entries.items():
+        (playlist_path / str(index)).symlink_to(symlink_target(relpath))
+
+def plan_symlink_update(env, playlist_path, removals, renames, creates):
+    ops = []
+    for index in removals:
+        ops.append(["unlink", home_relpath(env, playlist_path / str(index))])
+    for old_index, new_index in renames:
+        ops.append(["rename",
+                    home_relpath(env, playlist_path / str(old_index)),
+                    home_relpath(env, playlist_path / str(new_index))])
+    for index, relpath in creates:
+        ops.append(["symlink", home_relpath(env, playlist_path / str(index)),
+                    str(symlink_target(relpath))])
+    return ops
+
+# A playlist in file format is a directory holding a single file of
+# relpaths, one per line. The header gives the index of the first
+# line, and empty lines stand for gaps in the indices. Relpaths never
+# contain newlines since those are escaped by escape_string.
+
+def read_file_playlist(playlist_path):
+    entries_path = playlist_path / PLAYLIST_ENTRIES_FILE
+    entries = {}
+    try:
+        with open(entries_path, encoding="utf-8") as f:
+            header = f.readline().split()
+            if len(header) != 2 or header[0] != PLAYLIST_FILE_HEADER:
+                die("malformed playlist file: {}".format(entries_path))
+            try:
+                start = int(header[1])
+            except ValueError:
+                die("malformed playlist file: {}".format(entries_path))
+            for index, line in enumerate(f, start):
+                line = line.rstrip("\n")
+                if line:
+                    entries[index] = pathlib.Path(line)
+    except FileNotFoundError:
+        pass
+    return entries
+
+def format_file_playlist_lines(entries, start, end):
+    return "".join("{}\n".format(entries.get(index, ""))
+                   for index in range(start, end))
+
+def format_file_playlist(entries):
+    start = min(entries, default=0)
+    end = max(entries, default=-1) + 1
+    return "{} {}\n{}".format(
+        PLAYLIST_FILE_HEADER, start,
+        format_file_playlist_lines(entries, start, end))
+
+def write_file_atomically(env, path, text):
+    path_new = env["temp"] / path.name
+    path_new.parent.mkdir(parents=True, exist_ok=True)
+    with open(path_new, "w", encoding="utf-8") as f:
+        f.write(text)
+    path_new.rename(path)
+
+def write_file_playlist(env, playlist_path, entries):
+    write_file_atomically(
+        env, playlist_path / PLAYLIST_ENTRIES_FILE,
+        format_file_playlist(entries))
+
+def plan_file_update(env, playlist_path, removals, renames, creates):
+    entries_path = playlist_path / PLAYLIST_ENTRIES_FILE
+    entries = read_file_playlist(playlist_path)
+    end = max(entries, default=-1) + 1
+    if (entries and not removals and not renames and
+            min(index for index, _ in creates) >= end):
+        appended = dict(creates)
+        return [["append", home_relpath(env, entries_path),
+                 entries_path.stat().st_size,
+                 format_file_playlist_lines(
+                     appended, end, max(appended) + 1)]]
+    for index in removals:
+        del entries[index]
+    for old_index, new_index in renames:
+        entries[new_index] = entries.pop(old_index)
+    for index, relpath in creates:
+        entries[index] = relpath
+    return [["write", home_relpath(env, entries_path),
+             format_file_playlist(entries)]]
+
+def read_playlist_indices(env, playlist_path):
+    if env["playlist_format"] == "file":
+        return sorted(read_file_playlist(playlist_path))
+    return sorted(index for index, _ in iter_symlink_playlist(playlist_path))
+
+def read_playlist(env, playlist_path, predicate=lambda index: True,
+                  indices=None, plan_level=None):
+    # Return a dict from index to relpath of the entries whose index
+    # satisfies predicate. If indices is given, only those entries are
+    # looked up, instead of reading the whole playlist.
+    if plan_level is None:
+        plan_level = collections.Counter()
+    if env["playlist_format"] == "file":
+        entries = read_file_playlist(playlist_path)
+        plan_level["read"] += 1
+        plan_level["estimated"] += len(entries)
+        plan_level["touched"] += len(entries)
+        return {index: relpath for index, relpath in entries.items()
+                if predicate(index)}
+    return read_symlink_playlist(
+        env, playlist_path, predicate, indices, plan_level)
+
+def plan_playlist_update(env, playlist_path, removals, renames, creates):
+    if not (removals or renames or creates):
+        return []
+    if env["playlist_format"] == "file":
+        return plan_file_update(
+            env, playlist_path, removals, renames, creates)
+    return plan_symlink_update(env, playlist_path, removals, renames, creates)
+
+def order_renames(env, renames):
+    # Order a dict of renames from src to dst paths so that no dst is
+    # written while its current entry still has to be moved. Cycles
+    # are broken by moving one entry aside into temp/.
+    ordered = []
+    pending = dict(renames)
+    for start in renames:
+        if start not in pending:
+            continue
+        chain = [start]
+        dst = pending[start]
+        while dst in pending and dst != start:
+            chain.append(dst)
+            dst = pending[dst]
+        if dst == start:
+            temp_path = env["temp"] / "transfer-{}".format(len(ordered))
+            ordered.append((start, temp_path))
+            pending[temp_path] = pending.pop(start)
+            chain[0] = temp_path
+        for src in reversed(chain):
+            ordered.append((src, pending.pop(src)))
+    return ordered
+
+def plan_symlink_moves(env, removals, moves, creates):
+    ops = []
+    for playlist_path, index in removals:
+        ops.append(["unlink", home_relpath(env, playlist_path / str(index))])
+    renames = {
+        playlist_path / str(index): new_playlist_path / str(new_index)
+        for (playlist_path, index), (new_playlist_path, new_index)
+        in moves.items()
+    }
+    for src, dst in order_renames(env, renames):
+        ops.append(["rename", home_relpath(env, src), home_relpath(env, dst)])
+    for playlist_path, index, relpath in creates:
+        ops.append(["symlink", home_relpath(env, playlist_path / str(index)),
+                    str(symlink_target(relpath))])
+    return ops
+
+def plan_file_moves(env, removals, moves, creates):
+    playlist_paths = set()
+    for playlist_path, _ in removals:
+        playlist_paths.add(playlist_path)
+    for (playlist_path, _), (new_playlist_path, _) in moves.items():
+        playlist_paths.add(playlist_path)
+        playlist_paths.add(new_playlist_path)
+    for playlist_path, _, _ in creates:
+        playlist_paths.add(playlist_path)
+    entries = {path: read_file_playlist(path) for path in playlist_paths}
+    new_entries = {path: dict(entries[path]) for path in playlist_paths}
+    for playlist_path, index in removals:
+        del new_entries[playlist_path][index]
+    for playlist_path, index in moves:
+        del new_entries[playlist_path][index]
+    for (playlist_path, index), (new_playlist_path, new_index) in (
+            moves.items()):
+        new_entries[new_playlist_path][new_index] = (
+            entries[playlist_path][index])
+    for playlist_path, index, relpath in creates:
+        new_entries[playlist_path][index] = relpath
+    return [["write", home_relpath(env, path / PLAYLIST_ENTRIES_FILE),
+             format_file_playlist(new_entries[path])]
+            for path in sorted(playlist_paths)]
+
+def plan_playlist_moves(env, removals, moves, creates):
+    # Like plan_playlist_update, but entries may move between
+    # playlists. removals are (playlist_path, index) pairs, moves map
+    # such pairs to their new location, and creates are
+    # (playlist_path, index, relpath) triples.
+    if env["playlist_format"] == "file":
+        return plan_file_moves(env, removals, moves, creates)
+    return plan_symlink_moves(env, removals, moves, creates)
+
+def update_playlist(env, playlist_path, removals, renames, creates):
+    run_journal(env, plan_playlist_update(
+        env, playlist_path, removals, renames, creates))
+
+def migrate_playlists(env, playlist_format, yes):
+    old_format = env["playlist_format"]
+    if playlist_format == old_format:
+        log("playlists are already in {} format".format(playlist_format))
+        return
+    paths = []
+    if env["playlists"].is_dir():
+        paths = sorted(
+            path for path in env["playlists"].iterdir() if path.is_dir())
+    log("will convert {} playlist{} from {} format to {} format"
+        .format(*pluralens(paths), old_format, playlist_format))
+    if not are_you_sure(default=True, yes=yes):
+        die()
+    # Write the new representation next to the old one, then switch
+    # formats, then clean up. Each format ignores the other's files,
+    # so an interrupted migration leaves every playlist readable.
+    # Read every playlist before writing any, so that a playlist that
+    # cannot be read stops the migration before it has started.
+    playlist_entries = [read_playlist(env, path) for path in paths]
+    for path, entries in zip(paths, playlist_entries):
+        if playlist_format == "file":
+            write_file_playlist(env, path, entries)
+        else:
+            write_symlink_playlist(env, path, entries)
+    with applying(env):
+        set_playlist_format(env, playlist_format)
+        env["playlist_format"] = playlist_format
+        for path in paths:
+            if old_format == "file":
+                entries_path = path / PLAYLIST_ENTRIES_FILE
+                if entries_path.exists():
+                    entries_path.unlink()
+            else:
+                for _, entry_path in iter_symlink_playlist(path):
+                    entry_path.unlink()
+    log("converted {} playlist{} to {} format"
+        .format(*pluralens(paths), playlist_format))
+
 def create_playlists(env, playlists):
     for reserved_name in RESERVED_PLAYLISTS:
         if reserved_name in playlists:
@@ -355,8 +806,9 @@ def create_playlists(env, playlists):
             should_die = True
     if should_die:
         die()
-    for path in paths:
-        path.mkdir(parents=True)
+    with applying(env):
+        for path in paths:
+            path.mkdir(parents=True)
     log("created {} playlist{}".format(*pluralens(playlists)))
 
 def delete_playlists(env, playlists, yes):
@@ -380,15 +832,7 @@ def delete_playlists(env, playlists, yes):
     total_songs = 0
     deletion_list = []
     for playlist, path in zip(playlists, paths):
-        num_songs = 0
-        for entry_path in path.iterdir():
-            if not entry_path.is_symlink():
-                continue
-            try:
-                int(entry_path.name)
-            except ValueError:
-                continue
-            num_songs += 1
+        num_songs = len(read_playlist_indices(env, path))
         total_songs += num_songs
         deletion_list.append(
             "\n  {} ({} song{})"
@@ -397,10 +841,208 @@ def delete_playlists(env, playlists, yes):
         .format(*pluralens(paths), total_songs, "".join(deletion_list)))
     if not are_you_sure(default=total_songs == 0, yes=yes):
         die()
-    for path in paths:
-        shutil.rmtree(path)
+    with applying(env):
+        for path in paths:
+            shutil.rmtree(path)
     log("deleted {} playlist{}".format(*pluralens(playlists)))
 
+# Playlist mutations are planned as a list of ops, written to the
+# journal with a single fsync, and then applied. Each applied op is
+# recorded by appending a line to the journal (without fsync), so the
+# number of those lines is only a lower bound on the progress of an
+# interrupted run. The journal also records the state of every path
+# the ops touch, before and after each op, and recovery resumes after
+# the last op whose states match what is on disk. Replaying ops that
+# were already applied would otherwise shift entries a second time.
+
+def home_relpath(env, path):
+    return str(path.relative_to(env["home"]))
+
+@contextlib.contextmanager
+def locked(env, name, operation):
+    if name in env["held_locks"]:
+        yield
+        return
+    env["locks"].mkdir(parents=True, exist_ok=True)
+    with open(env["locks"] / name, "a") as f:
+        fcntl.flock(f, operation)
+        env["held_locks"].add(name)
+        try:
+            yield
+        finally:
+            env["held_locks"].remove(name)
+
+def writing(env):
+    return locked(env, "write", fcntl.LOCK_EX)
+
+def reading(env):
+    return locked(env, "apply", fcntl.LOCK_SH)
+
+def applying(env):
+    return locked(env, "apply", fcntl.LOCK_EX)
+
+def journal_state(env, path):
+    # The state of a path touched by the journal: its symlink target,
+    # a digest of its contents, or None if it does not exist. Media
+    # files are only ever renamed, so their inode identifies them
+    # without reading them.
+    if path.is_symlink():
+        return ["symlink", os.readlink(path)]
+    if env["media"] in path.parents:
+        try:
+            return ["media", path.stat().st_ino]
+        except FileNotFoundError:
+            return None
+    try:
+        with open(path, "rb") as f:
+            return ["file", hashlib.sha256(f.read()).hexdigest()]
+    except FileNotFoundError:
+        return None
+
+def journal_text_state(text):
+    return ["file", hashlib.sha256(text.encode("utf-8")).hexdigest()]
+
+def plan_journal_states(env, ops):
+    # Return the states of the touched paths before ops are applied,
+    # and the states changed by each op.
+    states = {}
+    before = {}
+    after = []
+    for kind, path, *args in ops:
+        relpaths = [path, args[0]] if kind == "rename" else [path]
+        for relpath in relpaths:
+            if relpath not in states:
+                states[relpath] = journal_state(env, env["home"] / relpath)
+                before[relpath] = states[relpath]
+        if kind == "unlink":
+            changes = {path: None}
+        elif kind == "rename":
+            changes = {}
+            if states[path] is not None:
+                changes = {path: None, args[0]: states[path]}
+        elif kind == "symlink":
+            changes = {path: ["symlink", args[0]]}
+        elif kind == "write":
+            changes = {path: journal_text_state(args[0])}
+        elif kind == "append":
+            size, text = args
+            with open(env["home"] / path, "rb") as f:
+                data = f.read(size) + text.encode("utf-8")
+            changes = {path: ["file", hashlib.sha256(data).hexdigest()]}
+        elif kind == "queue_index":
+            changes = {path: ["symlink", str(args[0])]}
+        else:
+            assert False, "unexpected journal op: {}".format(kind)
+        states.update(changes)
+        after.append(changes)
+    return before, after
+
+def find_journal_progress(env, before, after, done):
+    # Return the number of ops after which the touched paths are in
+    # the state found on disk, or None if there is no such number.
+    states = dict(before)
+    for changes in after[:done]:
+        states.update(changes)
+    actual = {relpath: journal_state(env, env["home"] / relpath)
+              for relpath in states}
+    mismatched = {relpath for relpath in states
+                  if states[relpath] != actual[relpath]}
+    progress = None
+    for count in range(done, len(after) + 1):
+        if not mismatched:
+            progress = count
+        if count == len(after):
+            break
+        for relpath, state in after[count].items():
+            if state == actual[relpath]:
+                mismatched.discard(relpath)
+            else:
+                mismatched.add(relpath)
+    return progress
+
+def apply_journal_op(env, op):
+    kind, path, *args = op
+    path = env["home"] / path
+    if kind == "unlink":
+        if path.exists() or path.is_symlink():
+            path.unlink()
+    elif kind == "rename":
+        if path.exists() or path.is_symlink():
+            (env["home"] / args[0]).parent.mkdir(parents=True, exist_ok=True)
+            path.rename(env["home"] / args[0])
+    elif kind == "symlink":
+        replace_symlink(env, path, args[0])
+    elif kind == "write":
+        write_file_atomically(env, path, args[0])
+    elif kind == "append":
+        size, text = args
+        with open(path, "r+", encoding="utf-8") as f:
+            f.truncate(size)
+            f.seek(size)
+            f.write(text)
+    elif kind == "queue_index":
+        set_queue_index(env, args[0])
+    else:
+        assert False, "unexpected journal op: {}".format(kind)
+
+def apply_journal(env, ops, journal, done=0):
+    with applying(env):
+        for op in ops[done:]:
+            apply_journal_op(env, op)
+            journal.write("done\n")
+            journal.flush()
+    journal.close()
+    env["journal"].unlink()
+
+def fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def run_journal(env, ops):
+    if not ops:
+        return
+    before, after = plan_journal_states(env, ops)
+    journal = open(env["journal"], "w", encoding="utf-8")
+    journal.write(json.dumps(
+        {"ops": ops, "before": before, "after": after}) + "\n")
+    journal.flush()
+    os.fsync(journal.fileno())
+    fsync_dir(env["home"])
+    apply_journal(env, ops, journal)
+
+def recover_journal(env):
+    if not env["journal"].exists():
+        return
+    with writing(env):
+        try:
+            with open(env["journal"], encoding="utf-8") as f:
+                lines = f.read().split("\n")
+        except FileNotFoundError:
+            return
+        try:
+            journal = json.loads(lines[0]) if len(lines) > 1 else None
+        except ValueError:
+            journal = None
+        if journal is None:
+            log("discarding incomplete journal: {}".format(env["journal"]))
+            env["journal"].unlink()
+            return
+        ops = journal["ops"]
+        done = len(lines) - 2
+        progress = find_journal_progress(
+            env, journal["before"], journal["after"], done)
+        if progress is None:
+            log("library does not match any step of interrupted operation, "
+                "resuming after step {}".format(done))
+            progress = done
+        log("finishing interrupted operation ({} of {} step{} done)"
+            .format(progress, *pluralens(ops)))
+        apply_journal(
+            env, ops, open(env["journal"], "a", encoding="utf-8"), progress)
+
 FSTUNES_HOME_ENV_VAR = "FSTUNES_HOME"
 FSTUNES_QUEUE_LENGTH_ENV_VAR = "FSTUNES_QUEUE_LENGTH"
 
@@ -430,11 +1072,47 @@ def combine_matchers(true_matchers, false_matchers):
     return ([(True, t) for t in true_matchers] +
             [(False, f) for f in false_matchers])
 
+def compile_text_matcher(matcher_type, expr):
+    if matcher_type == "regex":
+        try:
+            pattern = re.compile(expr)
+        except re.error as e:
+            die("invalid regular expression {}: {}".format(repr(expr), e))
+        return {
+            "type": "regex",
+            "pattern": pattern,
+        }
+    elif matcher_type == "prefix":
+        return {
+            "type": "prefix",
+            "value": expr,
+        }
+    elif matcher_type == "icase":
+        return {
+            "type": "icase",
+            "value": expr.casefold(),
+        }
+    assert False, "unexpected matcher type: {}".format(matcher_type)
+
+# Matchers on text fields also carry the escaped form of their value,
+# so that names on disk can be compared without unescaping them.
+# Escaping works character by character, so this is exact for
+# literals, sets and prefixes.
+
+def add_escaped_form(desc):
+    if desc["type"] in ("literal", "prefix"):
+        desc["escaped"] = escape_string(desc["value"])
+    elif desc["type"] == "set":
+        desc["escaped"] = {escape_string(value) for value in desc["values"]}
+
 def parse_matchers(args, default_to_media):
     match = args.match or []
     match_literal = args.match_literal or []
     match_set = args.match_set or []
     match_range = args.match_range or []
+    match_regex = args.match_regex or []
+    match_prefix = args.match_prefix or []
+    match_icase = args.match_icase or []
     match_all = args.match_all or []
     matchers = collections.defaultdict(list)
     for matcher_type, unparsed_matchers in (
@@ -442,8 +1120,19 @@ def parse_matchers(args, default_to_media):
             ("literal", match_literal),
             ("set", match_set),
             ("range", match_range),
+            ("regex", match_regex),
+            ("prefix", match_prefix),
+            ("icase", match_icase),
             ("all", match_all)):
         for unparsed_matcher in unparsed_matchers:
+            if (matcher_type == "guess" and
+                    re.fullmatch(r"[^=~]*~.*", unparsed_matcher, re.DOTALL)):
+                field, orig_expr = unparsed_matcher.split("~", maxsplit=1)
+                if field not in METADATA_FIELDS:
+                    die("unsupported field: {}".format(field))
+                matchers[field].append(
+                    compile_text_matcher("regex", orig_expr))
+                continue
             if matcher_type != "all":
                 try:
                     field, orig_expr = unparsed_matcher.split("=", maxsplit=1)
@@ -455,9 +1144,13 @@ def parse_matchers(args, default_to_media):
             if field not in METADATA_FIELDS:
                 die("unsupported field: {}".format(field))
             desc = {}
-            if matcher_type not in ("guess", "literal", "set", "range", "all"):
+            if matcher_type not in (
+                    "guess", "literal", "set", "range", "regex", "prefix",
+                    "icase", "all"):
                 assert False, (
                     "unexpected matcher type: {}".format(matcher_type))
+            if matcher_type in ("regex", "prefix", "icase"):
+                desc = compile_text_matcher(matcher_type, orig_expr)
             if matcher_type in ("literal", "guess") and "type" not in desc:
                 skip = False
                 expr = orig_expr
@@ -486,7 +1179,7 @@ def parse_matchers(args, default_to_media):
                             skip = True
                 if not skip:
                     desc["type"] = "set"
-                    desc["values"] = expr
+                    desc["values"] = set(expr)
             if matcher_type in ("range", "guess") and "type" not in desc:
                 skip = False
                 try:
@@ -515,13 +1208,17 @@ def parse_matchers(args, default_to_media):
                 desc["type"] = "all"
             if "type" not in desc:
                 die("invalid match expression: {}".format(orig_expr))
+            if field not in METADATA_INT_FIELDS:
+                add_escaped_form(desc)
             matchers[field].append(desc)
     if not matchers["from"]:
         if default_to_media:
-            matchers["from"] = [{
+            desc = {
                 "type": "literal",
                 "value": "media",
-            }]
+            }
+            add_escaped_form(desc)
+            matchers["from"] = [desc]
         else:
             die("you must select a playlist using -m from=PLAYLIST or similar")
     return matchers
@@ -556,24 +1253,55 @@ def apply_matchers(matchers, value):
         elif matcher["type"] == "range":
             if matcher["low"] <= value <= matcher["high"]:
                 return True
+        elif matcher["type"] == "regex":
+            if value is not None and matcher["pattern"].search(str(value)):
+                return True
+        elif matcher["type"] == "prefix":
+            if value is not None and str(value).startswith(matcher["value"]):
+                return True
+        elif matcher["type"] == "icase":
+            if (value is not None and
+                    str(value).casefold() == matcher["value"]):
+                return True
         else:
             assert False, "unexpected matcher type: {}".format(matcher["type"])
     return not matchers
 
+def apply_escaped_matchers(matchers, name):
+    # Like apply_matchers, but given a file name as escaped on disk. A
+    # name without escapes is the same as its unescaped value, and
+    # otherwise it is only unescaped if a matcher has no escaped form,
+    # as is the case for regex, icase and range matchers.
+    if ESCAPE_CHAR not in name:
+        return apply_matchers(matchers, name)
+    value = None
+    for matcher in matchers:
+        if matcher["type"] == "all":
+            return True
+        elif "escaped" not in matcher:
+            if value is None:
+                value = unescape_string(name)
+            if apply_matchers([matcher], value):
+                return True
+        elif matcher["type"] == "literal":
+            if name == matcher["escaped"]:
+                return True
+        elif matcher["type"] == "set":
+            if name in matcher["escaped"]:
+                return True
+        elif matcher["type"] == "prefix":
+            if name.startswith(matcher["escaped"]):
+                return True
+    return not matchers
+
 def get_queue_index(env):
     try:
         index = int(os.readlink(env["queue_current"]))
     except (OSError, ValueError):
-        min_value = math.inf
         try:
-            for entry_path in env["queue"].iterdir():
-                try:
-                    min_value = min(min_value, int(entry_path.name))
-                except ValueError:
-                    continue
+            index = min(read_playlist_indices(env, env["queue"]), default=0)
         except OSError:
-            pass
-        index = min_value if min_value != math.inf else 0
+            index = 0
     return index
 
 def set_queue_index(env, index):
@@ -581,79 +1309,221 @@ def set_queue_index(env, index):
     queue_current_path.parent.mkdir(parents=True, exist_ok=True)
     queue_current_path_new = env["temp"] / env["queue_current"].name
     queue_current_path_new.parent.mkdir(parents=True, exist_ok=True)
+    if queue_current_path_new.is_symlink():
+        queue_current_path_new.unlink()
     queue_current_path_new.symlink_to(str(index))
     queue_current_path_new.rename(queue_current_path)
 
-def collect_matched_songs(env, matchers):
+# Directories whose entries are named after a matched field are read
+# either by listing them or, when the matchers for that field only
+# accept a finite set of values, by looking up the escaped name of each
+# value. Whichever is estimated to touch fewer entries is used. The
+# choices and counts are recorded in the plan for --explain.
+
+DEFAULT_DIR_ESTIMATE = 32
+
+PLAN_LEVELS = (
+    ("artist", "media/ARTIST"),
+    ("album", "media/ARTIST/ALBUM"),
+    ("song", "media/ARTIST/ALBUM/SONG"),
+    ("playlist", "playlists/PLAYLIST"),
+    ("entry", "playlists/PLAYLIST/N"),
+)
+
+def new_plan():
+    return collections.defaultdict(collections.Counter)
+
+def lookup_values(matchers):
+    if not matchers:
+        return None
+    values = set()
+    for matcher in matchers:
+        if matcher["type"] == "literal":
+            values.add(matcher["value"])
+        elif matcher["type"] == "set":
+            values.update(matcher["values"])
+        else:
+            return None
+    return sorted(values)
+
+def estimate_subdirs(path):
+    # On most POSIX filesystems the link count of a directory is two
+    # plus its number of subdirectories. Some filesystems always
+    # report 1, in which case there is nothing to go on.
+    try:
+        nlink = path.stat().st_nlink
+    except OSError:
+        return 0
+    return nlink - 2 if nlink >= 2 else DEFAULT_DIR_ESTIMATE
+
+def list_dir(path, matchers, plan_level):
+    # The link count is only worth a stat when there is a choice to
+    # make. Otherwise the listing itself gives the count for the plan.
+    values = lookup_values(matchers)
+    estimated = None
+    if values is not None:
+        estimated = estimate_subdirs(path)
+    if values is not None and len(values) < estimated:
+        names = [escape_string(value) for value in values]
+        children = [path / name for name in names
+                    if name not in ("", os.curdir, os.pardir)]
+        plan_level["lookup"] += 1
+        plan_level["estimated"] += len(values)
+    else:
+        try:
+            children = list(path.iterdir())
+        except OSError:
+            children = []
+        plan_level["listing"] += 1
+        plan_level["estimated"] += (
+            len(children) if estimated is None else estimated)
+    plan_level["touched"] += len(children)
+    return children
+
+def merge_plan(plan, other):
+    for level, counts in other.items():
+        plan[level].update(counts)
+
+def map_dirs(function, paths, jobs):
+    # Call function on each path, reading up to jobs directories at
+    # once. Results are returned in the order of paths either way, so
+    # the outcome does not depend on which directory is read first.
+    if jobs <= 1 or len(paths) <= 1:
+        return list(map(function, paths))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(function, paths))
+
+def list_artist_albums(matchers, artist_path):
+    plan = new_plan()
+    album_paths = []
+    if not apply_escaped_matchers(matchers["artist"], artist_path.name):
+        return album_paths, plan
+    if not artist_path.is_dir():
+        return album_paths, plan
+    for album_path in list_dir(artist_path, matchers["album"], plan["album"]):
+        if not apply_escaped_matchers(matchers["album"], album_path.name):
+            continue
+        if not album_path.is_dir():
+            continue
+        album_paths.append(album_path)
+    return album_paths, plan
+
+def list_media_albums(env, matchers, plan, jobs):
+    artist_paths = list_dir(env["media"], matchers["artist"], plan["artist"])
+    album_paths = []
+    for artist_album_paths, artist_plan in map_dirs(
+            functools.partial(list_artist_albums, matchers),
+            artist_paths, jobs):
+        album_paths.extend(artist_album_paths)
+        merge_plan(plan, artist_plan)
+    return album_paths
+
+def list_playlists(env, matchers, plan):
+    playlist_paths = []
+    for playlist_path in list_dir(
+            env["playlists"], matchers["from"], plan["playlist"]):
+        if not apply_escaped_matchers(matchers["from"], playlist_path.name):
+            continue
+        playlist_paths.append(playlist_path)
+    return playlist_paths
+
+def collect_album_songs(env, matchers, album_path):
+    plan = new_plan()
+    songs = []
+    song_paths = list(album_path.iterdir())
+    plan["song"]["listing"] += 1
+    plan["song"]["estimated"] += DEFAULT_DIR_ESTIMATE
+    plan["song"]["touched"] += len(song_paths)
+    for song_path in song_paths:
+        if song_path.suffix not in MEDIA_EXTENSIONS:
+            continue
+        if not song_path.is_file():
+            continue
+        relpath = song_path.relative_to(env["media"])
+        metadata = parse_library_relpath(relpath)
+        disqualified = False
+        for field in ("disk", "track", "song", "extension"):
+            if not apply_matchers(matchers[field], metadata[field]):
+                disqualified = True
+                break
+        if disqualified:
+            continue
+        metadata["relpath"] = relpath
+        songs.append(metadata)
+    return songs, plan
+
+def collect_playlist_songs(env, matchers, playlist_path):
+    plan = new_plan()
+    songs = []
+    if not playlist_path.is_dir():
+        return songs, plan
+    playlist = unescape_string(playlist_path.name)
+    offset = get_queue_index(env) if playlist == QUEUE_PLAYLIST else 0
+    indices = lookup_values(matchers["index"])
+    if indices is not None and len(indices) < DEFAULT_DIR_ESTIMATE:
+        indices = [index + offset for index in indices]
+    else:
+        indices = None
+    entries = read_playlist(
+        env, playlist_path,
+        lambda index: apply_matchers(matchers["index"], index - offset),
+        indices=indices, plan_level=plan["entry"])
+    for index, relpath in entries.items():
+        index -= offset
+        metadata = parse_library_relpath(relpath)
+        disqualified = False
+        for field in ("artist", "album", "disk", "track", "song",
+                      "extension"):
+            if not apply_matchers(matchers[field], metadata[field]):
+                disqualified = True
+                break
+        if disqualified:
+            continue
+        metadata["from"] = playlist
+        metadata["index"] = index
+        metadata["relpath"] = relpath
+        songs.append(metadata)
+    return songs, plan
+
+def collect_matched_songs(env, matchers, plan=None, jobs=1):
+    if plan is None:
+        plan = new_plan()
     songs = []
     matches_media = (
         apply_matchers(matchers["from"], MEDIA_PLAYLIST) and
         env["media"].is_dir())
     if matches_media:
-        for artist_path in env["media"].iterdir():
-            artist = unescape_string(artist_path.name)
-            if not apply_matchers(matchers["artist"], artist):
-                continue
-            if not artist_path.is_dir():
-                continue
-            for album_path in artist_path.iterdir():
-                album = unescape_string(album_path.name)
-                if not apply_matchers(matchers["album"], album):
-                    continue
-                if not album_path.is_dir():
-                    continue
-                for song_path in album_path.iterdir():
-                    if song_path.suffix not in MEDIA_EXTENSIONS:
-                        continue
-                    if not song_path.is_file():
-                        continue
-                    relpath = song_path.relative_to(env["media"])
-                    metadata = parse_relpath(relpath)
-                    disqualified = False
-                    for field in ("disk", "track", "song", "extension"):
-                        if not apply_matchers(
-                                matchers[field], metadata[field]):
-                            disqualified = True
-                            break
-                    if disqualified:
-                        continue
-                    metadata["relpath"] = relpath
-                    songs.append(metadata)
+        for album_songs, album_plan in map_dirs(
+                functools.partial(collect_album_songs, env, matchers),
+                list_media_albums(env, matchers, plan, jobs), jobs):
+            songs.extend(album_songs)
+            merge_plan(plan, album_plan)
     if env["playlists"].is_dir():
-        for playlist_path in env["playlists"].iterdir():
-            playlist = unescape_string(playlist_path.name)
-            if not apply_matchers(matchers["from"], playlist):
-                continue
-            if not playlist_path.is_dir():
-                continue
-            offset = get_queue_index(env) if playlist == QUEUE_PLAYLIST else 0
-            for entry_path in playlist_path.iterdir():
-                try:
-                    index = int(entry_path.name)
-                except ValueError:
-                    continue
-                index += offset
-                if not apply_matchers(matchers["index"], index):
-                    continue
-                if not entry_path.is_symlink():
-                    continue
-                song_path = entry_path.resolve()
-                relpath = song_path.relative_to(env["media"])
-                metadata = parse_relpath(relpath)
-                disqualified = False
-                for field in ("artist", "album", "disk", "track", "song",
-                              "extension"):
-                    if not apply_matchers(matchers[field], metadata[field]):
-                        disqualified = True
-                        break
-                if disqualified:
-                    continue
-                metadata["from"] = playlist
-                metadata["index"] = index
-                metadata["relpath"] = relpath
-                songs.append(metadata)
+        for playlist_songs, playlist_plan in map_dirs(
+                functools.partial(collect_playlist_songs, env, matchers),
+                list_playlists(env, matchers, plan), jobs):
+            songs.extend(playlist_songs)
+            merge_plan(plan, playlist_plan)
     return songs
 
+def explain_plan(plan):
+    lines = []
+    for level, description in PLAN_LEVELS:
+        counts = plan[level]
+        if not counts:
+            continue
+        accesses = []
+        for access in ("lookup", "listing", "read"):
+            if counts[access]:
+                accesses.append("{} {}{}".format(
+                    counts[access], access, plural(counts[access])))
+        lines.append(
+            "\n  {}: {}; estimated {} entr{}, touched {}"
+            .format(description, ", ".join(accesses), counts["estimated"],
+                    "y" if counts["estimated"] == 1 else "ies",
+                    counts["touched"]))
+    log("query plan:{}".format("".join(lines)))
+
 def sort_songs(songs, sorters):
     for sorter in sorters:
         field = sorter["field"]
@@ -672,7 +1542,7 @@ def sort_songs(songs, sorters):
                     return ""
         else:
             def key(value):
-                if field in value:
+                if value.get(field) is not None:
                     return value[field]
                 elif field in METADATA_INT_FIELDS:
                     return -math.inf
@@ -705,19 +1575,12 @@ def insert_in_playlist(env, songs, playlist, insert_index, before, yes):
         global_offset = current_index
     else:
         global_offset = 0
-    playlist_path = env["playlists"] / playlist
+    playlist_path = env["playlists"] / escape_string(playlist)
     if playlist == QUEUE_PLAYLIST:
         playlist_path.mkdir(parents=True, exist_ok=True)
     elif not playlist_path.is_dir():
         die("playlist does not exist: {}".format(playlist))
-    existing_indices = []
-    for entry_path in playlist_path.iterdir():
-        try:
-            index = int(entry_path.name)
-        except ValueError:
-            continue
-        existing_indices.append(index)
-    existing_indices.sort()
+    existing_indices = read_playlist_indices(env, playlist_path)
     insertion_point = bisect.bisect_left(existing_indices, insert_index)
     insertion_list = []
     removals = []
@@ -725,34 +1588,34 @@ def insert_in_playlist(env, songs, playlist, insert_index, before, yes):
         removal_point = bisect.bisect_left(existing_indices, current_index)
         for i in range(removal_point - env["queue_length"]):
             index = existing_indices[i]
-            removals.append(playlist_path / str(index))
+            removals.append(index)
+    context_indices = set(existing_indices[
+        max(0, insertion_point - CONTEXT):insertion_point + CONTEXT])
+    context = read_playlist(
+        env, playlist_path, lambda index: index in context_indices)
     for i in range(max(0, insertion_point - CONTEXT), insertion_point):
         index = existing_indices[i]
-        song = parse_relpath(
-            (playlist_path / str(index)).resolve().relative_to(env["media"]))
+        song = parse_library_relpath(context[index])
         insertion_list.append(song_description(song, index - global_offset))
     insertion_list.append(CONTEXT_DIVIDER)
     creates = []
     for offset, song in enumerate(songs):
         song_index = insert_index + offset
-        target = pathlib.Path("..") / ".." / MEDIA_PLAYLIST / song["relpath"]
-        creates.append((playlist_path / str(song_index), target))
+        creates.append((song_index, song["relpath"]))
         insertion_list.append(
             song_description(song, song_index - global_offset))
     insertion_list.append(CONTEXT_DIVIDER)
     for i in range(insertion_point,
                    min(insertion_point + CONTEXT, len(existing_indices))):
         index = existing_indices[i]
-        song = parse_relpath(
-            (playlist_path / str(index)).resolve().relative_to(env["media"]))
+        song = parse_library_relpath(context[index])
         insertion_list.append(
             song_description(song, index + len(songs) - global_offset))
     renames = []
     for i in range(insertion_point, len(existing_indices)):
         old_index = existing_indices[i]
         new_index = old_index + len(songs)
-        renames.append((playlist_path / str(old_index),
-                        playlist_path / str(new_index)))
+        renames.append((old_index, new_index))
     renames.reverse()
     advance = False
     if playlist == QUEUE_PLAYLIST:
@@ -769,28 +1632,574 @@ def insert_in_playlist(env, songs, playlist, insert_index, before, yes):
                 ", advance pointer" if advance else ""))
     if not are_you_sure(default=True, yes=yes):
         die()
-    for removal in removals:
-        removal.unlink()
-    for rename, target in renames:
-        rename.rename(target)
-    for create, target in creates:
-        create.symlink_to(target)
+    ops = plan_playlist_update(env, playlist_path, removals, renames, creates)
     if advance:
-        set_queue_index(env, new_current_index)
+        ops.append(["queue_index", home_relpath(env, env["queue_current"]),
+                    new_current_index])
+    run_journal(env, ops)
     log("inserted {} song{} into playlist {} and pruned {} (length {} -> {})"
         .format(*pluralens(songs), repr(playlist),
                 len(removals), len(existing_indices),
                 len(existing_indices) + len(songs) - len(removals)))
 
+def transfer_to_playlist(env, songs, playlist, insert_index, before, yes):
+    # Move the matched entries out of their playlists and into the
+    # given one in a single plan. Each playlist that loses entries is
+    # compacted, the destination makes room for the new entries, and
+    # every entry whose location changes is renamed exactly once, so
+    # moved entries are never recreated.
+    if not before:
+        insert_index += 1
+    if playlist == MEDIA_PLAYLIST:
+        die("playlist name is reserved for fstunes: {}"
+            .format(MEDIA_PLAYLIST))
+    current_index = get_queue_index(env)
+    if playlist == QUEUE_PLAYLIST:
+        insert_index += current_index
+    playlist_path = env["playlists"] / escape_string(playlist)
+    if playlist == QUEUE_PLAYLIST:
+        playlist_path.mkdir(parents=True, exist_ok=True)
+    elif not playlist_path.is_dir():
+        die("playlist does not exist: {}".format(playlist))
+    offsets = {QUEUE_PLAYLIST: current_index}
+    sources = collections.defaultdict(list)
+    for song in songs:
+        if song.get("from", MEDIA_PLAYLIST) != MEDIA_PLAYLIST:
+            sources[song["from"]].append(
+                song["index"] + offsets.get(song["from"], 0))
+    for indices in sources.values():
+        indices.sort()
+    num_sources = len(sources)
+    paths = {name: env["playlists"] / escape_string(name)
+             for name in set(sources) | {playlist}}
+    removals = []
+    if playlist == QUEUE_PLAYLIST:
+        existing_indices = read_playlist_indices(env, playlist_path)
+        removal_point = bisect.bisect_left(existing_indices, current_index)
+        transferred = set(sources[QUEUE_PLAYLIST])
+        for i in range(removal_point - env["queue_length"]):
+            index = existing_indices[i]
+            if index not in transferred:
+                removals.append((playlist_path, index))
+    pruned = set(removals)
+    first_index = insert_index - bisect.bisect_left(
+        sources[playlist], insert_index)
+    moves = {}
+    for name, path in paths.items():
+        transferred = set(sources[name])
+        for index in read_playlist_indices(env, path):
+            if index in transferred or (path, index) in pruned:
+                continue
+            new_index = index - bisect.bisect_left(sources[name], index)
+            if name == playlist and index >= insert_index:
+                new_index += len(songs)
+            if new_index != index:
+                moves[(path, index)] = (path, new_index)
+    creates = []
+    transfer_list = []
+    for offset, song in enumerate(songs):
+        song_index = first_index + offset
+        if song.get("from", MEDIA_PLAYLIST) == MEDIA_PLAYLIST:
+            creates.append((playlist_path, song_index, song["relpath"]))
+        else:
+            path = paths[song["from"]]
+            index = song["index"] + offsets.get(song["from"], 0)
+            if (path, index) != (playlist_path, song_index):
+                moves[(path, index)] = (playlist_path, song_index)
+        transfer_list.append(song_description(
+            song, song_index - offsets.get(playlist, 0)))
+    new_current_index = current_index - bisect.bisect_left(
+        sources[QUEUE_PLAYLIST], current_index)
+    if playlist == QUEUE_PLAYLIST and current_index > insert_index:
+        new_current_index += len(songs)
+    advance = new_current_index != current_index
+    ops = plan_playlist_moves(env, removals, moves, creates)
+    if advance:
+        ops.append(["queue_index", home_relpath(env, env["queue_current"]),
+                    new_current_index])
+    num_between = sum(1 for (path, _), (new_path, _) in moves.items()
+                      if path != new_path)
+    log("will transfer the following {} song{} from {} playlist{} "
+        "into playlist {}:{}"
+        .format(*pluralens(songs), *plurals(num_sources), repr(playlist),
+                "".join(transfer_list)))
+    log("will move {} symlink{} within playlists and {} between them, "
+        "insert {}, prune {}{}"
+        .format(*plurals(len(moves) - num_between), num_between,
+                len(creates), len(removals),
+                ", move pointer" if advance else ""))
+    if not are_you_sure(default=True, yes=yes):
+        die()
+    run_journal(env, ops)
+    log("transferred {} song{} into playlist {} and pruned {}"
+        .format(*pluralens(songs), repr(playlist), len(removals)))
+
 def insert_songs(
-        env, matchers, sorters, playlist, index, transfer, before, yes):
-    if transfer:
-        raise NotImplementedError
-    songs = collect_matched_songs(env, matchers)
+        env, matchers, sorters, playlist, index, transfer, before, yes,
+        explain, jobs):
+    plan = new_plan()
+    songs = collect_matched_songs(env, matchers, plan, jobs)
+    if explain:
+        explain_plan(plan)
     if not songs:
         die("no songs matched")
     sort_songs(songs, sorters)
-    insert_in_playlist(env, songs, playlist, index, before=before, yes=yes)
+    if transfer:
+        transfer_to_playlist(
+            env, songs, playlist, index, before=before, yes=yes)
+    else:
+        insert_in_playlist(
+            env, songs, playlist, index, before=before, yes=yes)
+
+SUMMARY_FIELDS = ("artist", "album", "from")
+
+# Fields that can only be read by parsing the name of each media file.
+FILE_FIELDS = ("disk", "track", "song", "extension")
+
+def parse_fields(args):
+    if not args.fields:
+        return list(METADATA_FIELDS)
+    fields = args.fields.split(",")
+    for field in fields:
+        if field not in METADATA_FIELDS:
+            die("unsupported field: {}".format(field))
+    return fields
+
+def field_value(name):
+    value = unescape_string(name)
+    return None if value == MISSING_FIELD else value
+
+def summary_key(field, artist, album, playlist):
+    if field == "artist":
+        return (artist,)
+    elif field == "album":
+        return (artist, album)
+    elif field == "from":
+        return (playlist,)
+    assert False, "unexpected summary field: {}".format(field)
+
+def count_album_songs(album_path):
+    # Count the same entries as collect_album_songs. The file type
+    # comes with the listing on most filesystems, so this needs no
+    # stat per entry.
+    plan = new_plan()
+    with os.scandir(album_path) as it:
+        entries = list(it)
+    plan["song"]["listing"] += 1
+    plan["song"]["estimated"] += DEFAULT_DIR_ESTIMATE
+    plan["song"]["touched"] += len(entries)
+    num_songs = sum(
+        1 for entry in entries
+        if os.path.splitext(entry.name)[1] in MEDIA_EXTENSIONS and
+        entry.is_file())
+    return num_songs, plan
+
+def summarize_playlist(env, matchers, field, playlist_path):
+    plan = new_plan()
+    counts = collections.Counter()
+    if not playlist_path.is_dir():
+        return counts, plan
+    playlist = unescape_string(playlist_path.name)
+    offset = get_queue_index(env) if playlist == QUEUE_PLAYLIST else 0
+    if field == "from" and not matchers["artist"] and not matchers["album"]:
+        if env["playlist_format"] == "file":
+            indices = read_playlist_indices(env, playlist_path)
+        else:
+            indices = read_symlink_indices(playlist_path)
+        plan["entry"]["listing"] += 1
+        plan["entry"]["estimated"] += DEFAULT_DIR_ESTIMATE
+        plan["entry"]["touched"] += len(indices)
+        num_songs = sum(
+            1 for index in indices
+            if apply_matchers(matchers["index"], index - offset))
+        if num_songs:
+            counts[(playlist,)] += num_songs
+        return counts, plan
+    entries = read_playlist(
+        env, playlist_path,
+        lambda index: apply_matchers(matchers["index"], index - offset),
+        plan_level=plan["entry"])
+    for relpath in entries.values():
+        artist_name, album_name = relpath.parts[:2]
+        if not apply_escaped_matchers(matchers["artist"], artist_name):
+            continue
+        if not apply_escaped_matchers(matchers["album"], album_name):
+            continue
+        counts[summary_key(
+            field, field_value(artist_name), field_value(album_name),
+            playlist)] += 1
+    return counts, plan
+
+def summarize_songs(env, matchers, field, plan, jobs):
+    # Count songs using only directory listings (and, for artists and
+    # albums in playlists, symlink targets), unless a matcher needs
+    # fields that are only known after parsing each file name.
+    counts = collections.Counter()
+    if any(matchers[file_field] for file_field in FILE_FIELDS):
+        for song in collect_matched_songs(env, matchers, plan, jobs):
+            counts[summary_key(
+                field, song["artist"], song["album"],
+                song.get("from", MEDIA_PLAYLIST))] += 1
+        return counts
+    matches_media = (
+        apply_matchers(matchers["from"], MEDIA_PLAYLIST) and
+        env["media"].is_dir())
+    if matches_media:
+        album_paths = list_media_albums(env, matchers, plan, jobs)
+        for album_path, (num_songs, album_plan) in zip(
+                album_paths, map_dirs(count_album_songs, album_paths, jobs)):
+            merge_plan(plan, album_plan)
+            if num_songs:
+                counts[summary_key(
+                    field, field_value(album_path.parent.name),
+                    field_value(album_path.name), MEDIA_PLAYLIST)] += num_songs
+    if env["playlists"].is_dir():
+        for playlist_counts, playlist_plan in map_dirs(
+                functools.partial(summarize_playlist, env, matchers, field),
+                list_playlists(env, matchers, plan), jobs):
+            counts.update(playlist_counts)
+            merge_plan(plan, playlist_plan)
+    return counts
+
+def format_field(value):
+    return MISSING_FIELD if value is None else str(value)
+
+def list_songs(env, matchers, sorters, fields, summary, explain, jobs):
+    plan = new_plan()
+    if summary:
+        counts = summarize_songs(env, matchers, summary, plan, jobs)
+        if explain:
+            explain_plan(plan)
+        for key in sorted(counts, key=lambda key: tuple(
+                (value is None, value or "") for value in key)):
+            print("\t".join([*map(format_field, key), str(counts[key])]))
+        return
+    songs = collect_matched_songs(env, matchers, plan, jobs)
+    if explain:
+        explain_plan(plan)
+    sort_songs(songs, sorters)
+    for song in songs:
+        if "from" not in song:
+            song = dict(song, **{"from": MEDIA_PLAYLIST})
+        print("\t".join(format_field(song.get(field)) for field in fields))
+
+def remove_path(path):
+    if path.is_dir() and not path.is_symlink():
+        shutil.rmtree(path)
+    else:
+        path.unlink()
+
+def replace_symlink(env, path, target):
+    temp_path = env["temp"] / path.name
+    temp_path.parent.mkdir(parents=True, exist_ok=True)
+    if temp_path.exists() or temp_path.is_symlink():
+        temp_path.unlink()
+    temp_path.symlink_to(target)
+    temp_path.rename(path)
+
+def reset_queue_index(env):
+    env["queue_current"].unlink()
+    set_queue_index(env, get_queue_index(env))
+
+def remove_empty_album(album_path):
+    album_path.rmdir()
+    try:
+        album_path.parent.rmdir()
+    except OSError:
+        # The artist still has other albums.
+        pass
+
+def fsck_escaped_name(path, problems):
+    if escape_string(unescape_string(path.name)) != path.name:
+        problems.append((path, "name is not escaped canonically", None))
+
+def fsck_artist(env, artist_entry):
+    # Return the problems found, the relpaths of the media files, and
+    # a dict from relpath to canonical relpath of the files that the
+    # repair renames. The fix of a problem is either a function or a
+    # list of journal ops, see fsck_library.
+    problems = []
+    relpaths = []
+    renames = {}
+    artist_path = pathlib.Path(artist_entry.path)
+    if not artist_entry.is_dir():
+        problems.append((artist_path, "not a directory", None))
+        return problems, relpaths, renames
+    fsck_escaped_name(artist_path, problems)
+    with os.scandir(artist_path) as it:
+        album_entries = sorted(it, key=lambda e: e.name)
+    if not album_entries:
+        problems.append((artist_path, "empty directory", artist_path.rmdir))
+    for album_entry in album_entries:
+        album_path = pathlib.Path(album_entry.path)
+        if not album_entry.is_dir():
+            problems.append((album_path, "not a directory", None))
+            continue
+        fsck_escaped_name(album_path, problems)
+        with os.scandir(album_path) as it:
+            song_entries = sorted(it, key=lambda e: e.name)
+        if not song_entries:
+            problems.append(
+                (album_path, "empty directory",
+                 functools.partial(remove_empty_album, album_path)))
+        for song_entry in song_entries:
+            song_path = pathlib.Path(song_entry.path)
+            if not song_entry.is_file():
+                problems.append((song_path, "not a regular file", None))
+                continue
+            relpath = song_path.relative_to(env["media"])
+            relpaths.append(str(relpath))
+            if song_path.suffix not in MEDIA_EXTENSIONS:
+                problems.append(
+                    (song_path, "extension {} not recognized"
+                     .format(repr(song_path.suffix)), None))
+                continue
+            try:
+                metadata = parse_relpath(relpath)
+            except ValueError:
+                metadata = parse_legacy_relpath(relpath)
+                if metadata is None:
+                    problems.append((song_path, "malformed file name", None))
+                    continue
+            canonical_relpath = create_relpath(metadata)
+            if canonical_relpath != relpath:
+                # Playlist entries that point at the file are updated
+                # by the repairs found in fsck_playlist.
+                canonical_path = env["media"] / canonical_relpath
+                message = "file name is not canonical, expected {}".format(
+                    canonical_relpath)
+                fix = None
+                if (canonical_path.exists() or
+                        str(canonical_relpath) in renames.values()):
+                    message += ", which already exists"
+                elif canonical_path.parent == song_path.parent:
+                    renames[str(relpath)] = str(canonical_relpath)
+                    fix = [["rename", home_relpath(env, song_path),
+                            home_relpath(env, canonical_path)]]
+                problems.append((song_path, message, fix))
+    return problems, relpaths, renames
+
+def fsck_playlist(env, media_relpaths, repaired_relpaths, playlist_entry):
+    problems = []
+    playlist_path = pathlib.Path(playlist_entry.path)
+    if not playlist_entry.is_dir():
+        problems.append((playlist_path, "not a directory", None))
+        return problems
+    fsck_escaped_name(playlist_path, problems)
+    if env["playlist_format"] == "file":
+        fsck_file_playlist(
+            env, media_relpaths, repaired_relpaths, playlist_path, problems)
+    else:
+        fsck_symlink_playlist(
+            env, media_relpaths, repaired_relpaths, playlist_path, problems)
+    return problems
+
+def fsck_entry_target(media_relpaths, repaired_relpaths, relpath):
+    # Return the relpath that an entry pointing at relpath should point
+    # at once the repair has renamed media files, or None if there is
+    # no such file. Entries may still use names that an earlier repair
+    # (or this one) changed to their canonical form.
+    if relpath in media_relpaths:
+        return media_relpaths[relpath]
+    try:
+        metadata = parse_relpath(relpath)
+    except ValueError:
+        metadata = parse_legacy_relpath(relpath)
+        if metadata is None:
+            return None
+    canonical_relpath = str(create_relpath(metadata))
+    if canonical_relpath in repaired_relpaths:
+        return canonical_relpath
+    return None
+
+def describe_indices(message, indices):
+    return message.format(
+        "y" if len(indices) == 1 else "ies",
+        ", ".join(str(index) for index in indices))
+
+def fsck_file_playlist(env, media_relpaths, repaired_relpaths, playlist_path,
+                       problems):
+    for entry in scan_dir(playlist_path):
+        entry_path = pathlib.Path(entry.path)
+        if entry_path == env["queue_current"]:
+            continue
+        if entry.name == PLAYLIST_ENTRIES_FILE:
+            continue
+        try:
+            int(entry.name)
+        except ValueError:
+            problems.append((entry_path, "not a playlist entry", None))
+            continue
+        problems.append((entry_path, "left over from symlink format",
+                         entry_path.unlink))
+    dangling = []
+    retargets = []
+    for index, relpath in sorted(read_file_playlist(playlist_path).items()):
+        relpath = str(relpath)
+        target = None
+        if os.path.normpath(relpath) == relpath:
+            target = fsck_entry_target(
+                media_relpaths, repaired_relpaths, relpath)
+        if target is None:
+            dangling.append(index)
+        elif target != relpath or relpath not in media_relpaths:
+            retargets.append((index, pathlib.Path(target)))
+    # Both kinds of problems rewrite the same file, so they are
+    # repaired together.
+    messages = []
+    if dangling:
+        messages.append(describe_indices(
+            "dangling entr{} at index {}", dangling))
+    if retargets:
+        messages.append(describe_indices(
+            "entr{} at index {} point at renamed files",
+            [index for index, _ in retargets]))
+    if messages:
+        problems.append(
+            (playlist_path / PLAYLIST_ENTRIES_FILE, "; ".join(messages),
+             plan_playlist_update(
+                 env, playlist_path, dangling, [], retargets)))
+
+def fsck_symlink_playlist(env, media_relpaths, repaired_relpaths,
+                          playlist_path, problems):
+    prefix = os.path.join(os.pardir, os.pardir, MEDIA_PLAYLIST) + os.sep
+    retargets = []
+    for entry in scan_dir(playlist_path):
+        entry_path = pathlib.Path(entry.path)
+        if entry_path == env["queue_current"]:
+            continue
+        if entry.name == PLAYLIST_ENTRIES_FILE:
+            problems.append((entry_path, "left over from file format",
+                             entry_path.unlink))
+            continue
+        try:
+            index = int(entry.name)
+        except ValueError:
+            problems.append((entry_path, "not a playlist entry", None))
+            continue
+        if str(index) != entry.name:
+            canonical_path = playlist_path / str(index)
+            problems.append(
+                (entry_path, "index is not canonical, expected {}"
+                 .format(index),
+                 None if canonical_path.is_symlink()
+                 else functools.partial(entry_path.rename, canonical_path)))
+            continue
+        if not entry.is_symlink():
+            problems.append((entry_path, "not a symlink", None))
+            continue
+        target = os.readlink(entry.path)
+        if target.startswith(prefix) and os.path.normpath(target) == target:
+            relpath = target[len(prefix):]
+            canonical = True
+        else:
+            relpath = os.path.relpath(
+                os.path.normpath(os.path.join(str(playlist_path), target)),
+                str(env["media"]))
+            canonical = False
+        repaired_relpath = fsck_entry_target(
+            media_relpaths, repaired_relpaths, relpath)
+        if repaired_relpath is None:
+            problems.append(
+                (entry_path, "dangling symlink to {}".format(target),
+                 entry_path.unlink))
+            continue
+        if repaired_relpath != relpath or relpath not in media_relpaths:
+            retargets.append((index, pathlib.Path(repaired_relpath)))
+            continue
+        if not canonical:
+            canonical_target = prefix + relpath
+            problems.append(
+                (entry_path, "symlink target is not canonical, expected {}"
+                 .format(canonical_target),
+                 functools.partial(
+                     replace_symlink, env, entry_path, canonical_target)))
+    if retargets:
+        problems.append(
+            (playlist_path, describe_indices(
+                "entr{} at index {} point at renamed files",
+                [index for index, _ in retargets]),
+             plan_playlist_update(env, playlist_path, [], [], retargets)))
+
+def fsck_queue_index(env):
+    path = env["queue_current"]
+    if not path.is_symlink():
+        if path.exists():
+            return [(path, "queue pointer is not a symlink",
+                     functools.partial(reset_queue_index, env))]
+        return []
+    try:
+        int(os.readlink(path))
+    except ValueError:
+        return [(path, "queue pointer is not an integer",
+                 functools.partial(reset_queue_index, env))]
+    return []
+
+def scan_dir(path):
+    try:
+        with os.scandir(path) as it:
+            return sorted(it, key=lambda e: e.name)
+    except FileNotFoundError:
+        return []
+
+def fsck_library(env, jobs, repair, yes):
+    problems = []
+    for temp_entry in scan_dir(env["temp"]):
+        temp_path = pathlib.Path(temp_entry.path)
+        problems.append((temp_path, "leftover temporary file",
+                         functools.partial(remove_path, temp_path)))
+    # A dict from the relpath of each media file to its relpath once
+    # repaired, and the set of the latter.
+    media_relpaths = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        for artist_problems, relpaths, renames in executor.map(
+                functools.partial(fsck_artist, env), scan_dir(env["media"])):
+            problems.extend(artist_problems)
+            media_relpaths.update(
+                (relpath, renames.get(relpath, relpath))
+                for relpath in relpaths)
+        repaired_relpaths = set(media_relpaths.values())
+        for playlist_problems in executor.map(
+                functools.partial(
+                    fsck_playlist, env, media_relpaths, repaired_relpaths),
+                scan_dir(env["playlists"])):
+            problems.extend(playlist_problems)
+    problems.extend(fsck_queue_index(env))
+    log("checked {} media file{}".format(*pluralens(media_relpaths)))
+    if not problems:
+        log("no problems found")
+        return
+    repairable = []
+    problem_list = []
+    for path, message, fix in problems:
+        if fix:
+            repairable.append(fix)
+        problem_list.append(
+            "\n  {}: {}{}"
+            .format(path, message, "" if fix else " (not repairable)"))
+    log("found {} problem{} ({} repairable):{}"
+        .format(*pluralens(problems), len(repairable),
+                "".join(problem_list)))
+    if not repair or not repairable:
+        die()
+    log("will repair {} problem{}".format(*pluralens(repairable)))
+    if not are_you_sure(default=True, yes=yes):
+        die()
+    # Media renames and the playlist entries that follow them are
+    # applied as a single journal plan, after the other repairs, so
+    # that an interrupted repair cannot leave entries pointing at the
+    # old names.
+    ops = []
+    with applying(env):
+        for fix in repairable:
+            if callable(fix):
+                fix()
+            else:
+                ops.extend(fix)
+        run_journal(env, ops)
+    log("repaired {} problem{}".format(*pluralens(repairable)))
+    if len(repairable) < len(problems):
+        die()
 
 def handle_args(args):
     home = os.environ.get(FSTUNES_HOME_ENV_VAR)
@@ -813,6 +2222,8 @@ def handle_args(args):
                 .format(FSTUNES_QUEUE_LENGTH_ENV_VAR, queue_length))
     else:
         queue_length = 10000
+    if getattr(args, "jobs", 1) < 1:
+        die("number of jobs must be positive: {}".format(args.jobs))
     env = {
         "home": home,
         "media": home / MEDIA_PLAYLIST,
@@ -821,20 +2232,57 @@ def handle_args(args):
         "queue_current": home / "playlists" / QUEUE_PLAYLIST / "_current",
         "queue_length": queue_length,
         "temp": home / "temp",
+        "journal": home / "journal",
+        "locks": home / "locks",
+        "held_locks": set(),
     }
+    recover_journal(env)
+    if args.subcommand == "import":
+        lock = contextlib.nullcontext()
+    elif (args.subcommand in ("playlist", "insert") or
+          args.subcommand == "fsck" and args.repair):
+        lock = writing(env)
+    else:
+        lock = reading(env)
+    with lock:
+        env["playlist_format"] = get_playlist_format(home)
+        run_subcommand(env, args)
+
+def run_subcommand(env, args):
     if args.subcommand == "import":
-        import_music(env, args.paths)
+        if args.from_stdin:
+            if args.paths:
+                die("cannot give paths together with --from-stdin")
+            filepaths = read_stdin_paths(b"\0" if args.null else b"\n")
+        else:
+            if not args.paths:
+                die("no paths given (use --from-stdin to read them)")
+            if args.null:
+                die("--null only makes sense with --from-stdin")
+            filepaths = walk_paths(args.paths)
+        import_music(env, filepaths)
     elif args.subcommand == "playlist":
         if args.subcommand_playlist == "create":
             create_playlists(env, args.playlists)
-        else:
+        elif args.subcommand_playlist == "delete":
             delete_playlists(env, args.playlists, yes=args.yes)
+        else:
+            migrate_playlists(env, args.format, yes=args.yes)
     elif args.subcommand == "insert":
         matchers = parse_matchers(args, default_to_media=True)
         sorters = parse_sorters(args)
         insert_songs(
             env, matchers, sorters, args.playlist, args.index,
-            transfer=args.transfer, before=args.before, yes=args.yes)
+            transfer=args.transfer, before=args.before, yes=args.yes,
+            explain=args.explain, jobs=args.jobs)
+    elif args.subcommand == "list":
+        matchers = parse_matchers(args, default_to_media=True)
+        sorters = parse_sorters(args)
+        fields = parse_fields(args)
+        list_songs(env, matchers, sorters, fields, summary=args.summary,
+                   explain=args.explain, jobs=args.jobs)
+    elif args.subcommand == "fsck":
+        fsck_library(env, args.jobs, repair=args.repair, yes=args.yes)
     else:
         raise NotImplementedError
 